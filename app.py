@@ -11,13 +11,21 @@
 # ------------------------------------------------------------
 
 import io
+import math
 import zipfile
-import xml.etree.ElementTree as ET
 from decimal import Decimal, ROUND_HALF_UP
+from typing import NamedTuple
 
+import lxml.etree as ET
+import numpy as np
 import pandas as pd
 import streamlit as st
 
+try:
+    from numba import njit  # opcional: acelera a matemática do checklist em NF-es grandes
+except ModuleNotFoundError:
+    njit = None
+
 # --------------------- Configuração da Página ---------------------
 st.set_page_config(
     page_title="Conferência XML Reforma Tributária",
@@ -79,185 +87,296 @@ uploaded = st.file_uploader("Carregue o arquivo XML da NF-e", type=["xml"])
 # Namespaces
 ns = {"nfe": "http://www.portalfiscal.inf.br/nfe", "ds": "http://www.w3.org/2000/09/xmldsig#"}
 
+# --------------------- XPaths pré-compiladas ---------------------
+# Compiladas uma única vez no carregamento do módulo; o string(...) devolve o texto
+# direto da libxml2 ("" quando o nó não existe), sem reconstruir o mapa de namespaces.
+def _xp(path: str):
+    return ET.XPath(path, namespaces=ns)
+
+# Cabeçalho (relativas ao próprio ide/emit/dest)
+TPAMB      = _xp("string(nfe:tpAmb)")
+CNPJ       = _xp("string(nfe:CNPJ)")
+IE         = _xp("string(nfe:IE)")
+DEST_UF    = _xp("string(nfe:enderDest/nfe:UF)")
+IND_IEDEST = _xp("string(nfe:indIEDest)")
+
+# Totais (relativas ao total)
+VBC_TOTAL  = _xp("string(nfe:IBSCBSTot/nfe:vBCIBSCBS)")
+VIBS_TOTAL = _xp("string(nfe:IBSCBSTot/nfe:gIBS/nfe:vIBS)")
+VCBS_TOTAL = _xp("string(nfe:IBSCBSTot/nfe:gCBS/nfe:vCBS)")
+VNF        = _xp("string(nfe:ICMSTot/nfe:vNF)")
+
+# --------------------- Tags qualificadas (notação Clark) ---------------------
+# find() com a tag já qualificada não precisa resolver prefixo nem dicionário de namespaces.
+NFE = "{%s}" % ns["nfe"]
+Q_PROD    = NFE + "prod"
+Q_IMPOSTO = NFE + "imposto"
+Q_ICMS    = NFE + "ICMS"
+Q_PIS     = NFE + "PIS"
+Q_COFINS  = NFE + "COFINS"
+Q_IPI     = NFE + "IPI"
+Q_IPITRIB = NFE + "IPITrib"
+Q_IPINT   = NFE + "IPINT"
+Q_IBSCBS  = NFE + "IBSCBS"
+Q_GIBSCBS = NFE + "gIBSCBS"
+Q_GCBS    = NFE + "gCBS"
+
+# Campos folha (filhos diretos de prod / do grupo do tributo)
+Q_CPROD      = NFE + "cProd"
+Q_NCM        = NFE + "NCM"
+Q_CFOP       = NFE + "CFOP"
+Q_VPROD      = NFE + "vProd"
+Q_VFRETE     = NFE + "vFrete"
+Q_VSEG       = NFE + "vSeg"
+Q_VDESC      = NFE + "vDesc"
+Q_VOUTRO     = NFE + "vOutro"
+Q_CST        = NFE + "CST"
+Q_CCLASSTRIB = NFE + "cClassTrib"
+Q_VBC        = NFE + "vBC"
+Q_PICMS      = NFE + "pICMS"
+Q_VICMS      = NFE + "vICMS"
+Q_PPIS       = NFE + "pPIS"
+Q_VPIS       = NFE + "vPIS"
+Q_PCOFINS    = NFE + "pCOFINS"
+Q_VCOFINS    = NFE + "vCOFINS"
+Q_VIPI       = NFE + "vIPI"
+Q_VIBS       = NFE + "vIBS"
+Q_VCBS       = NFE + "vCBS"
+
+# Elementos emitidos pelo iterparse (filhos diretos de infNFe)
+ITER_TAGS = tuple(NFE + t for t in ("ide", "emit", "dest", "det", "total"))
+
 # --------------------- Utilitários ---------------------
+_ZERO = Decimal("0.00")
+
 def d(s: str) -> Decimal:
-    """Converte string para Decimal de forma segura."""
+    """Converte string para Decimal de forma segura (vazio vira zero sem passar pelo construtor)."""
+    if not s:
+        return _ZERO
     try:
         return Decimal(s)
     except Exception:
-        return Decimal("0.00")
+        return _ZERO
+
+def round_half_up(values: np.ndarray) -> np.ndarray:
+    """
+    Arredonda para 2 casas com ROUND_HALF_UP (como Decimal.quantize), de forma vetorizada.
+    O round intermediário elimina o ruído binário do float (ex.: 409.4999999 -> 409.5).
+    """
+    return np.floor(np.round(values * 100, 6) + 0.5) / 100
+
+# Abaixo disso o custo de despacho do JIT supera o ganho sobre o NumPy
+NUMBA_MIN_ITENS = 50
+
+def _check_math_loop(vBC, vIBS, vCBS, p_ibs, p_cbs, tol):
+    """Laço item a item equivalente a check_math; compilado com numba quando disponível."""
+    n = vBC.shape[0]
+    ok_ibs = np.empty(n, dtype=np.bool_)
+    ok_cbs = np.empty(n, dtype=np.bool_)
+    expected_ibs = np.empty(n, dtype=np.float64)
+    expected_cbs = np.empty(n, dtype=np.float64)
+    for i in range(n):
+        e_ibs = math.floor(round(vBC[i] * p_ibs * 100, 6) + 0.5) / 100
+        e_cbs = math.floor(round(vBC[i] * p_cbs * 100, 6) + 0.5) / 100
+        expected_ibs[i] = e_ibs
+        expected_cbs[i] = e_cbs
+        ok_ibs[i] = round(abs(vIBS[i] - e_ibs), 2) <= tol
+        ok_cbs[i] = round(abs(vCBS[i] - e_cbs), 2) <= tol
+    return ok_ibs, ok_cbs, expected_ibs, expected_cbs
+
+_check_math_jit = njit(cache=True)(_check_math_loop) if njit is not None else None
+
+def check_math(vBC, vIBS, vCBS, p_ibs: float, p_cbs: float, tol: float):
+    """
+    Confere vIBS = vBC * p_ibs e vCBS = vBC * p_cbs (2 casas, ROUND_HALF_UP) por item.
+    Retorna (ok_ibs, ok_cbs, expected_ibs, expected_cbs) como arrays NumPy.
+    """
+    if _check_math_jit is not None and len(vBC) >= NUMBA_MIN_ITENS:
+        return _check_math_jit(vBC, vIBS, vCBS, p_ibs, p_cbs, tol)
+    expected_ibs = round_half_up(vBC * p_ibs)
+    expected_cbs = round_half_up(vBC * p_cbs)
+    ok_ibs = np.round(np.abs(vIBS - expected_ibs), 2) <= tol
+    ok_cbs = np.round(np.abs(vCBS - expected_cbs), 2) <= tol
+    return ok_ibs, ok_cbs, expected_ibs, expected_cbs
+
+def child_texts(elem) -> dict:
+    """
+    Mapa {tag qualificada: texto} dos filhos diretos de elem ({} se elem for None).
+    Uma passagem pelos filhos atende todas as leituras de um passo do grupo.
+    """
+    if elem is None:
+        return {}
+    return {ch.tag: ch.text or "" for ch in elem}
 
-def gettext(elem, path: str) -> str:
-    """Busca o texto de um elemento com namespace de forma segura."""
+def child_elems(elem) -> dict:
+    """Mapa {tag qualificada: elemento} dos filhos diretos de elem ({} se elem for None)."""
     if elem is None:
-        return ""
-    found = elem.find(path, ns)
-    return found.text if found is not None else ""
+        return {}
+    return {ch.tag: ch for ch in elem}
+
+def first_child(elem):
+    """Primeiro filho de elem (o grupo específico do tributo), ou None."""
+    return elem[0] if (elem is not None and len(elem)) else None
+
+def iter_nfe(source):
+    """
+    Percorre o XML em passagem única (iterparse), gerando (tag, elemento) para
+    ide, emit, dest, det e total. Após o consumo, cada elemento é limpo e os irmãos
+    anteriores são descartados, de modo que a árvore inteira nunca fica em memória.
+    O documento é lido até o fim, para que erros de sintaxe em qualquer ponto
+    (inclusive assinatura e protNFe) continuem sendo reportados.
+    source é um arquivo binário (ex.: o UploadedFile), lido em blocos pelo parser.
+    """
+    context = ET.iterparse(
+        source, events=("end",), tag=ITER_TAGS,
+        resolve_entities=False, no_network=True,  # XML vem de upload do usuário
+        remove_comments=True, remove_pis=True,    # grupo[0] deve ser sempre um elemento
+    )
+    for _, elem in context:
+        yield ET.QName(elem).localname, elem
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    del context
+
+# --------------------- Leitura por Item ---------------------
+# Colunas devolvidas por read_det; as cinco últimas são a base do TOTAL ITEM e
+# são descartadas depois do cálculo.
+QUADRO_COLS = (
+    "Ordem", "Código do produto", "NCM", "CFOP",
+    "CST ICMS", "BC ICMS", "ALÍQUOTA ICMS", "VALOR ICMS",
+    "CST PIS", "BASE PIS", "ALÍQUOTA PIS", "VALOR PIS",
+    "CST COFINS", "BASE COFINS", "ALÍQUOTA COFINS", "VALOR COFINS",
+    "CST IBS", "CLASSETRIB (IBS)", "BASE IBS", "VALOR IBS",
+    "CST CBS", "CLASSETRIB (CBS)", "BASE CBS", "VALOR CBS",
+    "BASE IPI", "VALOR IPI",
+    "vProd", "vFrete", "vSeg", "vDesc", "vOutro",
+)
 
-def parse_xml(content: bytes):
-    """Parse do conteúdo XML e retorna a raiz."""
-    tree = ET.parse(io.BytesIO(content))
-    root = tree.getroot()
-    return root
+def read_det(det) -> tuple:
+    """
+    Extrai um det em uma tupla na ordem de QUADRO_COLS. Os valores ficam como texto;
+    a conversão numérica é feita por coluna em build_quadro. Cada nível estrutural
+    (det, imposto, IPI, IBSCBS, gIBSCBS) é percorrido uma só vez num mapa
+    {tag: elemento}, em vez de um find() por grupo; os campos folha vêm de child_texts.
+    """
+    nItem = det.get("nItem", "")
+    det_m = child_elems(det)
+    imp_m = child_elems(det_m.get(Q_IMPOSTO))
+    ipi_m = child_elems(imp_m.get(Q_IPI))
+    ibscbs_node = imp_m.get(Q_IBSCBS)
+    g_node = child_elems(ibscbs_node).get(Q_GIBSCBS)
+    g_m    = child_elems(g_node)
+
+    prod   = child_texts(det_m.get(Q_PROD))
+    icms   = child_texts(first_child(imp_m.get(Q_ICMS)))
+    pis    = child_texts(first_child(imp_m.get(Q_PIS)))
+    cof    = child_texts(first_child(imp_m.get(Q_COFINS)))
+    ipi    = child_texts(ipi_m.get(Q_IPITRIB, ipi_m.get(Q_IPINT)))
+    ibscbs = child_texts(ibscbs_node)
+    g      = child_texts(g_node)
+    gcbs   = child_texts(g_m.get(Q_GCBS))
+
+    cst_ibs = ibscbs.get(Q_CST, "")
+    cclass  = ibscbs.get(Q_CCLASSTRIB, "")
+    vBC_ibs = g.get(Q_VBC, "")
+
+    # Mesma ordem de QUADRO_COLS
+    return (
+        int(nItem) if nItem else None,
+        prod.get(Q_CPROD, ""), prod.get(Q_NCM, ""), prod.get(Q_CFOP, ""),
+        icms.get(Q_CST, ""), icms.get(Q_VBC, ""), icms.get(Q_PICMS, ""), icms.get(Q_VICMS, ""),
+        pis.get(Q_CST, ""), pis.get(Q_VBC, ""), pis.get(Q_PPIS, ""), pis.get(Q_VPIS, ""),
+        cof.get(Q_CST, ""), cof.get(Q_VBC, ""), cof.get(Q_PCOFINS, ""), cof.get(Q_VCOFINS, ""),
+        cst_ibs, cclass, vBC_ibs, g.get(Q_VIBS, ""),
+        cst_ibs, cclass, vBC_ibs, gcbs.get(Q_VCBS, ""),
+        ipi.get(Q_VBC, ""), ipi.get(Q_VIPI, ""),
+        prod.get(Q_VPROD, ""), prod.get(Q_VFRETE, ""), prod.get(Q_VSEG, ""),
+        prod.get(Q_VDESC, ""), prod.get(Q_VOUTRO, ""),
+    )
 
 # --------------------- Quadro Resumo por Item ---------------------
-def build_quadro(root) -> pd.DataFrame:
+def build_quadro(rows: list) -> pd.DataFrame:
     """
     Monta o quadro por item com as colunas solicitadas:
     Ordem; Código do produto; NCM; CFOP; CST ICMS; BC ICMS; ALÍQUOTA ICMS; VALOR ICMS;
     CST PIS; BASE PIS; ALÍQUOTA PIS; VALOR PIS; CST COFINS; BASE COFINS; ALÍQUOTA COFINS; VALOR COFINS;
     CST IBS; CLASSETRIB (IBS); BASE IBS; VALOR IBS; CST CBS; CLASSETRIB (CBS); BASE CBS; VALOR CBS;
     BASE IPI; VALOR IPI; TOTAL ITEM (NT)
+    O índice das linhas de item guarda a posição do det no documento (usada pelo checklist).
     """
-    rows = []
-    for det in root.findall(".//nfe:det", ns):
-        nItem = det.attrib.get("nItem", "")
-        prod = det.find("nfe:prod", ns)
-        imposto = det.find("nfe:imposto", ns)
-
-        # Valores base p/ total do item
-        vProd = d(gettext(prod, "nfe:vProd"))
-        vFrete = d(gettext(prod, "nfe:vFrete"))
-        vSeg   = d(gettext(prod, "nfe:vSeg"))
-        vDesc  = d(gettext(prod, "nfe:vDesc"))
-        vOutro = d(gettext(prod, "nfe:vOutro"))
-
-        cProd = gettext(prod, "nfe:cProd")
-        ncm   = gettext(prod, "nfe:NCM")
-        cfop  = gettext(prod, "nfe:CFOP")
-
-        # --- ICMS ---
-        icms_parent = imposto.find("nfe:ICMS", ns) if imposto is not None else None
-        icms_node = list(icms_parent)[0] if (icms_parent is not None and len(icms_parent)) else None
-        cst_icms = gettext(icms_node, "nfe:CST")
-        vBC_icms = d(gettext(icms_node, "nfe:vBC"))
-        pICMS    = d(gettext(icms_node, "nfe:pICMS"))
-        vICMS    = d(gettext(icms_node, "nfe:vICMS"))
-
-        # --- PIS ---
-        pis_parent = imposto.find("nfe:PIS", ns) if imposto is not None else None
-        pis_node = list(pis_parent)[0] if (pis_parent is not None and len(pis_parent)) else None
-        cst_pis = gettext(pis_node, "nfe:CST")
-        vBC_pis = d(gettext(pis_node, "nfe:vBC"))
-        pPIS    = d(gettext(pis_node, "nfe:pPIS"))
-        vPIS    = d(gettext(pis_node, "nfe:vPIS"))
-
-        # --- COFINS ---
-        cof_parent = imposto.find("nfe:COFINS", ns) if imposto is not None else None
-        cof_node = list(cof_parent)[0] if (cof_parent is not None and len(cof_parent)) else None
-        cst_cof = gettext(cof_node, "nfe:CST")
-        vBC_cof = d(gettext(cof_node, "nfe:vBC"))
-        pCOFINS = d(gettext(cof_node, "nfe:pCOFINS"))
-        vCOFINS = d(gettext(cof_node, "nfe:vCOFINS"))
-
-        # --- IPI ---
-        ipi_parent = imposto.find("nfe:IPI", ns) if imposto is not None else None
-        ipi_node = None
-        if ipi_parent is not None and len(ipi_parent):
-            for ch in list(ipi_parent):
-                tag = ch.tag.split("}")[1] if "}" in ch.tag else ch.tag
-                if tag in ("IPITrib", "IPINT"):
-                    ipi_node = ch
-                    break
-        vBC_ipi = d(gettext(ipi_node, "nfe:vBC"))
-        vIPI    = d(gettext(ipi_node, "nfe:vIPI"))
-
-        # --- IBSCBS ---
-        ibscbs = imposto.find("nfe:IBSCBS", ns) if imposto is not None else None
-        cst_ibs = gettext(ibscbs, "nfe:CST")
-        cclass  = gettext(ibscbs, "nfe:cClassTrib")
-        g       = ibscbs.find("nfe:gIBSCBS", ns) if ibscbs is not None else None
-        vBC_ibs = d(gettext(g, "nfe:vBC"))
-        vIBS    = d(gettext(g, "nfe:vIBS"))
-        gCBS    = g.find("nfe:gCBS", ns) if g is not None else None
-        cst_cbs    = cst_ibs
-        cclass_cbs = cclass
-        vBC_cbs    = vBC_ibs
-        vCBS       = d(gettext(gCBS, "nfe:vCBS") if gCBS is not None else "")
-
-        # TOTAL ITEM (NT-style): vProd + vFrete + vSeg + vOutro - vDesc + vIPI
-        total_item = (vProd + vFrete + vSeg + vOutro - vDesc + vIPI).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-
-        rows.append({
-            "Ordem": int(nItem) if nItem else None,
-            "Código do produto": cProd,
-            "NCM": ncm,
-            "CFOP": cfop,
-            "CST ICMS": cst_icms,
-            "BC ICMS": float(vBC_icms),
-            "ALÍQUOTA ICMS": float(pICMS),
-            "VALOR ICMS": float(vICMS),
-            "CST PIS": cst_pis,
-            "BASE PIS": float(vBC_pis),
-            "ALÍQUOTA PIS": float(pPIS),
-            "VALOR PIS": float(vPIS),
-            "CST COFINS": cst_cof,
-            "BASE COFINS": float(vBC_cof),
-            "ALÍQUOTA COFINS": float(pCOFINS),
-            "VALOR COFINS": float(vCOFINS),
-            "CST IBS": cst_ibs,
-            "CLASSETRIB (IBS)": cclass,
-            "BASE IBS": float(vBC_ibs),
-            "VALOR IBS": float(vIBS),
-            "CST CBS": cst_cbs,
-            "CLASSETRIB (CBS)": cclass_cbs,
-            "BASE CBS": float(vBC_cbs),
-            "VALOR CBS": float(vCBS),
-            "BASE IPI": float(vBC_ipi),
-            "VALOR IPI": float(vIPI),
-            "TOTAL ITEM (NT)": float(total_item),
-        })
-
-    df = pd.DataFrame(rows).sort_values("Ordem")
-
-    # Linha TOTAL
+    # Transpõe as tuplas de read_det em uma lista por coluna (zip em C) e monta o
+    # DataFrame coluna a coluna, sem a conversão linha -> coluna do construtor.
+    columns = list(zip(*rows)) or [()] * len(QUADRO_COLS)
+    df = pd.DataFrame(
+        {name: list(values) for name, values in zip(QUADRO_COLS, columns)}, copy=False
+    )
+
+    # Conversão numérica por coluna (float64); campo ausente/inválido vale 0
     numeric_cols = [
         "BC ICMS","ALÍQUOTA ICMS","VALOR ICMS","BASE PIS","ALÍQUOTA PIS","VALOR PIS",
         "BASE COFINS","ALÍQUOTA COFINS","VALOR COFINS","BASE IBS","VALOR IBS",
         "BASE CBS","VALOR CBS","BASE IPI","VALOR IPI","TOTAL ITEM (NT)"
     ]
-    totals = {col: Decimal(str(df[col].sum())).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP) for col in numeric_cols}
+    base_cols = ["vProd", "vFrete", "vSeg", "vDesc", "vOutro"]
+    for col in numeric_cols[:-1] + base_cols:
+        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0.0)
+
+    # TOTAL ITEM (NT-style): vProd + vFrete + vSeg + vOutro - vDesc + vIPI
+    df["TOTAL ITEM (NT)"] = (
+        df["vProd"] + df["vFrete"] + df["vSeg"] + df["vOutro"] - df["vDesc"] + df["VALOR IPI"]
+    ).round(2)
+    df = df.drop(columns=base_cols).sort_values("Ordem")
+
+    # Linha TOTAL
+    totals_series = round_half_up(df[numeric_cols].sum())
     totals_row = {k: "" for k in df.columns}
     totals_row.update({"Ordem": "TOTAL"})
-    for col, val in totals.items():
-        totals_row[col] = float(val)
+    totals_row.update(totals_series.to_dict())
 
-    df_total = pd.concat([df, pd.DataFrame([totals_row])], ignore_index=True)
-    return df_total
+    df.loc[len(df)] = totals_row
+    return df
 
 # --------------------- Checklist Obrigatório ---------------------
-def build_checklist(root, ibs_pct: float, cbs_pct: float, tol: float) -> pd.DataFrame:
+class CheckRow(NamedTuple):
+    """Linha do checklist. Tupla sem __dict__; o DataFrame usa os campos como colunas."""
+    Grupo: str
+    Campo: str
+    Regra: str
+    Status: str
+    Encontrado: str
+    Esperado: str
+
+def build_checklist(df_quadro: pd.DataFrame, header: dict, ibs_pct: float, cbs_pct: float, tol: float) -> pd.DataFrame:
     """
-    Gera checklist obrigatório:
+    Gera checklist obrigatório a partir do quadro e do cabeçalho de parse_and_quadro:
     - tpAmb == 2
     - emit/dest (CNPJ, IE, UF), indIEDest == 1
     - Por item: IBSCBS com CST, cClassTrib, vBC, vIBS e vCBS
     - Matemática por item (fase teste 2026): vIBS = vBC * p_ibs; vCBS = vBC * p_cbs (2 casas)
-    - Totais: soma dos itens = totais do bloco IBSCBSTot
+    - Totais: soma dos itens = totais do bloco IBSCBSTot (dentro da tolerância)
     """
     checks = []
 
     def add(grupo, campo, regra, ok, encontrado=None, esperado=None):
-        checks.append({
-            "Grupo": grupo,
-            "Campo": campo,
-            "Regra": regra,
-            "Status": "✅" if ok else "❌",
-            "Encontrado": "" if encontrado is None else str(encontrado),
-            "Esperado": "" if esperado is None else str(esperado),
-        })
+        checks.append(CheckRow(
+            grupo, campo, regra,
+            "✅" if ok else "❌",
+            "" if encontrado is None else str(encontrado),
+            "" if esperado is None else str(esperado),
+        ))
 
     # Cabeçalho
-    tpAmb = gettext(root, ".//nfe:ide/nfe:tpAmb")
+    tpAmb = header["tpAmb"]
     add("Cabeçalho", "ide/tpAmb", "Deve ser 2 (homologação)", tpAmb == "2", tpAmb, "2")
 
     # Partes
-    emit_cnpj = gettext(root, ".//nfe:emit/nfe:CNPJ")
-    emit_ie   = gettext(root, ".//nfe:emit/nfe:IE")
-    dest_cnpj = gettext(root, ".//nfe:dest/nfe:CNPJ")
-    dest_ie   = gettext(root, ".//nfe:dest/nfe:IE")
-    dest_uf   = gettext(root, ".//nfe:dest/nfe:enderDest/nfe:UF")
-    indIEDest = gettext(root, ".//nfe:dest/nfe:indIEDest")
+    emit_cnpj = header["emit_cnpj"]
+    emit_ie   = header["emit_ie"]
+    dest_cnpj = header["dest_cnpj"]
+    dest_ie   = header["dest_ie"]
+    dest_uf   = header["dest_uf"]
+    indIEDest = header["indIEDest"]
 
     add("Partes", "emit/CNPJ", "Preenchido", bool(emit_cnpj), emit_cnpj)
     add("Partes", "emit/IE",   "Preenchido", bool(emit_ie),   emit_ie)
@@ -266,51 +385,80 @@ def build_checklist(root, ibs_pct: float, cbs_pct: float, tol: float) -> pd.Data
     add("Partes", "dest/UF",   "Preenchido", bool(dest_uf),   dest_uf)
     add("Partes", "dest/indIEDest", "Deve ser 1 (contribuinte)", indIEDest == "1", indIEDest, "1")
 
-    # Itens + matemática
-    sum_vBC  = Decimal("0.00")
-    sum_vIBS = Decimal("0.00")
-    sum_vCBS = Decimal("0.00")
-    tol_dec = Decimal(str(tol))
-    p_ibs   = Decimal(str(ibs_pct/100.0))
-    p_cbs   = Decimal(str(cbs_pct/100.0))
-
-    for idx, det in enumerate(root.findall(".//nfe:det", ns), start=1):
-        imp    = det.find("nfe:imposto", ns)
-        ibscbs = imp.find("nfe:IBSCBS", ns) if imp is not None else None
-        cst    = gettext(ibscbs, "nfe:CST")
-        cclass = gettext(ibscbs, "nfe:cClassTrib")
-        g      = ibscbs.find("nfe:gIBSCBS", ns) if ibscbs is not None else None
-        vBC    = d(gettext(g, "nfe:vBC"))
-        vIBS   = d(gettext(g, "nfe:vIBS"))
-        gCBS   = g.find("nfe:gCBS", ns) if g is not None else None
-        vCBS   = d(gettext(gCBS, "nfe:vCBS") if gCBS is not None else "")
-
+    # Itens + matemática (vetorizada sobre as colunas do quadro, sem a linha TOTAL),
+    # na ordem do documento: o quadro vem ordenado por Ordem, o checklist não
+    itens = df_quadro.iloc[:-1].sort_index()
+    vBC  = itens["BASE IBS"].to_numpy(dtype=float)
+    vIBS = itens["VALOR IBS"].to_numpy(dtype=float)
+    vCBS = itens["VALOR CBS"].to_numpy(dtype=float)
+    ok_ibs, ok_cbs, expected_vIBS, expected_vCBS = check_math(
+        vBC, vIBS, vCBS, ibs_pct / 100.0, cbs_pct / 100.0, tol
+    )
+
+    for idx, (cst, cclass, bc, ibs, cbs, exp_ibs, exp_cbs, ok_i, ok_c) in enumerate(zip(
+        itens["CST IBS"], itens["CLASSETRIB (IBS)"], vBC, vIBS, vCBS,
+        expected_vIBS, expected_vCBS, ok_ibs, ok_cbs,
+    ), start=1):
         add(f"Item {idx}", "IBSCBS/CST", "Preenchido", bool(cst), cst)
         add(f"Item {idx}", "IBSCBS/cClassTrib", "Preenchido", bool(cclass), cclass)
-        add(f"Item {idx}", "IBSCBS/vBC", "Preenchido (>0 quando tributado)", vBC > 0, vBC)
-
-        expected_vIBS = (vBC * p_ibs).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        expected_vCBS = (vBC * p_cbs).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        ok_ibs = abs(vIBS - expected_vIBS) <= tol_dec
-        ok_cbs = abs(vCBS - expected_vCBS) <= tol_dec
-        add(f"Item {idx}", "VALOR IBS", f"vBC × {ibs_pct:.2f}% (2 casas)", ok_ibs, vIBS, expected_vIBS)
-        add(f"Item {idx}", "VALOR CBS", f"vBC × {cbs_pct:.2f}% (2 casas)", ok_cbs, vCBS, expected_vCBS)
-
-        sum_vBC  += vBC
-        sum_vIBS += vIBS
-        sum_vCBS += vCBS
+        add(f"Item {idx}", "IBSCBS/vBC", "Preenchido (>0 quando tributado)", bc > 0, f"{bc:.2f}")
+        add(f"Item {idx}", "VALOR IBS", f"vBC × {ibs_pct:.2f}% (2 casas)", ok_i, f"{ibs:.2f}", f"{exp_ibs:.2f}")
+        add(f"Item {idx}", "VALOR CBS", f"vBC × {cbs_pct:.2f}% (2 casas)", ok_c, f"{cbs:.2f}", f"{exp_cbs:.2f}")
 
     # Totais do bloco IBSCBSTot
-    vBC_total  = d(gettext(root, ".//nfe:IBSCBSTot/nfe:vBCIBSCBS"))
-    vIBS_total = d(gettext(root, ".//nfe:IBSCBSTot/nfe:gIBS/nfe:vIBS"))
-    vCBS_total = d(gettext(root, ".//nfe:IBSCBSTot/nfe:gCBS/nfe:vCBS"))
+    sum_vBC, sum_vIBS, sum_vCBS = vBC.sum(), vIBS.sum(), vCBS.sum()
+    vBC_total  = d(header["vBC_total"])
+    vIBS_total = d(header["vIBS_total"])
+    vCBS_total = d(header["vCBS_total"])
+
+    def confere(soma, total) -> bool:
+        return round(abs(soma - float(total)), 2) <= tol
 
-    add("Totais", "IBSCBSTot/vBCIBSCBS", "Σ vBC_itens",  sum_vBC == vBC_total,  vBC_total,  sum_vBC)
-    add("Totais", "IBSCBSTot/gIBS/vIBS", "Σ vIBS_itens", sum_vIBS == vIBS_total, vIBS_total, sum_vIBS)
-    add("Totais", "IBSCBSTot/gCBS/vCBS", "Σ vCBS_itens", sum_vCBS == vCBS_total, vCBS_total, sum_vCBS)
+    add("Totais", "IBSCBSTot/vBCIBSCBS", "Σ vBC_itens",  confere(sum_vBC, vBC_total),   vBC_total,  f"{sum_vBC:.2f}")
+    add("Totais", "IBSCBSTot/gIBS/vIBS", "Σ vIBS_itens", confere(sum_vIBS, vIBS_total), vIBS_total, f"{sum_vIBS:.2f}")
+    add("Totais", "IBSCBSTot/gCBS/vCBS", "Σ vCBS_itens", confere(sum_vCBS, vCBS_total), vCBS_total, f"{sum_vCBS:.2f}")
 
     return pd.DataFrame(checks)
 
+# --------------------- Processamento em passagem única ---------------------
+# Cache limitado: poucas entradas e expiração curta, para que quadro e cabeçalho
+# (CNPJ, IE, valores) não fiquem retidos no servidor além do uso na sessão.
+@st.cache_data(show_spinner=False, max_entries=8, ttl="15m")
+def parse_and_quadro(source) -> tuple[pd.DataFrame, dict]:
+    """
+    Lê o XML uma única vez e monta o quadro. Não depende dos parâmetros da sidebar,
+    então fica em cache pelo conteúdo do arquivo (o Streamlit faz o hash do
+    UploadedFile pelo nome, posição e bytes): alterar alíquotas/tolerância só
+    refaz o checklist. source é lido direto pelo parser, sem cópia intermediária.
+    Retorna (df_quadro, header).
+    """
+    header = dict.fromkeys(
+        ("tpAmb", "emit_cnpj", "emit_ie", "dest_cnpj", "dest_ie", "dest_uf", "indIEDest",
+         "vBC_total", "vIBS_total", "vCBS_total", "vNF"), ""
+    )
+    rows = []
+    source.seek(0)
+    for tag, elem in iter_nfe(source):
+        if tag == "det":
+            rows.append(read_det(elem))
+        elif tag == "ide":
+            header["tpAmb"] = TPAMB(elem)
+        elif tag == "emit":
+            header["emit_cnpj"] = CNPJ(elem)
+            header["emit_ie"]   = IE(elem)
+        elif tag == "dest":
+            header["dest_cnpj"] = CNPJ(elem)
+            header["dest_ie"]   = IE(elem)
+            header["dest_uf"]   = DEST_UF(elem)
+            header["indIEDest"] = IND_IEDEST(elem)
+        elif tag == "total":
+            header["vBC_total"]  = VBC_TOTAL(elem)
+            header["vIBS_total"] = VIBS_TOTAL(elem)
+            header["vCBS_total"] = VCBS_TOTAL(elem)
+            header["vNF"]        = VNF(elem)
+
+    return build_quadro(rows), header
+
 # --------------------- Exportação: Excel se possível, ZIP-CSV se não ---------------------
 def _choose_excel_engine():
     """Escolhe engine disponível: openpyxl > xlsxwriter; None se nenhuma instalada."""
@@ -324,18 +472,41 @@ def _choose_excel_engine():
         except ModuleNotFoundError:
             return None
 
+def _iter_rows(df: pd.DataFrame):
+    """Linhas do DataFrame como tuplas (sem índice); NaN vira célula vazia."""
+    if df.isna().to_numpy().any():
+        df = df.astype(object).where(df.notna(), None)
+    return df.itertuples(index=False, name=None)
+
 def to_export_bytes(dfs: dict):
     """
     Se houver engine (openpyxl/xlsxwriter), gera XLSX em memória.
+    As linhas são gravadas em fluxo, sem passar pelo to_excel do pandas: openpyxl em
+    modo write-only ou xlsxwriter com constant_memory (uma linha por vez em memória).
     Caso contrário, gera um ZIP com os CSVs (sem dependências extras).
     Retorna (bytes, filename, mime).
     """
     engine = _choose_excel_engine()
     if engine is not None:
         output = io.BytesIO()
-        with pd.ExcelWriter(output, engine=engine) as writer:
+        if engine == "openpyxl":
+            from openpyxl import Workbook
+            wb = Workbook(write_only=True)
             for sheet, df in dfs.items():
-                df.to_excel(writer, index=False, sheet_name=sheet[:31])  # limite de 31 chars
+                ws = wb.create_sheet(sheet[:31])  # limite de 31 chars
+                ws.append(list(df.columns))
+                for row in _iter_rows(df):
+                    ws.append(row)
+            wb.save(output)
+        else:
+            import xlsxwriter
+            workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+            for sheet, df in dfs.items():
+                ws = workbook.add_worksheet(sheet[:31])  # limite de 31 chars
+                ws.write_row(0, 0, list(df.columns))
+                for i, row in enumerate(_iter_rows(df), start=1):
+                    ws.write_row(i, 0, row)
+            workbook.close()
         return output.getvalue(), "conferencia_xml_reforma_tributaria.xlsx", \
                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     else:
@@ -345,35 +516,57 @@ def to_export_bytes(dfs: dict):
                 zf.writestr(f"{sheet}.csv", df.to_csv(index=False))
         return zbuf.getvalue(), "conferencia_xml_reforma_tributaria.zip", "application/zip"
 
+# --------------------- Exibição ---------------------
+# O st.dataframe serializa o DataFrame inteiro para o navegador a cada rerun;
+# acima deste limite a tela mostra só uma prévia e o conjunto completo fica no download.
+PREVIEW_ROWS = 200
+
+def show_preview(df: pd.DataFrame, keep=None, note: str = ""):
+    """
+    Exibe as linhas marcadas em keep (máscara booleana) sempre, e as demais até
+    PREVIEW_ROWS, na ordem original. Só as linhas fora de keep são cortadas.
+    """
+    keep = np.zeros(len(df), dtype=bool) if keep is None else np.asarray(keep, dtype=bool)
+    mask = keep | (np.cumsum(~keep) <= PREVIEW_ROWS)
+    if mask.all():
+        st.dataframe(df, use_container_width=True, hide_index=True)
+        return
+    preview = df[mask]
+    st.dataframe(preview, use_container_width=True, hide_index=True)
+    st.caption(f"Mostrando {len(preview)} de {len(df)} linhas{note}. Baixe o arquivo completo abaixo.")
+
 # --------------------- Execução Principal ---------------------
 if uploaded is not None:
     try:
-        root = parse_xml(uploaded.read())
+        uploaded.seek(0)  # a posição entra na chave do cache
+        df_quadro, header = parse_and_quadro(uploaded)
 
         # Resumo do cabeçalho
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Ambiente (tpAmb)", gettext(root, ".//nfe:ide/nfe:tpAmb") or "—")
+            st.metric("Ambiente (tpAmb)", header["tpAmb"] or "—")
         with col2:
-            st.metric("Emitente (CNPJ)", gettext(root, ".//nfe:emit/nfe:CNPJ") or "—")
+            st.metric("Emitente (CNPJ)", header["emit_cnpj"] or "—")
         with col3:
-            st.metric("Destinatário (CNPJ)", gettext(root, ".//nfe:dest/nfe:CNPJ") or "—")
+            st.metric("Destinatário (CNPJ)", header["dest_cnpj"] or "—")
         with col4:
-            st.metric("UF Destinatário", gettext(root, ".//nfe:dest/nfe:enderDest/nfe:UF") or "—")
+            st.metric("UF Destinatário", header["dest_uf"] or "—")
 
         # Quadro Resumo por Item
         st.subheader("Quadro Resumo por Item")
-        df_quadro = build_quadro(root)
-        st.dataframe(df_quadro, use_container_width=True)
+        show_preview(df_quadro, keep=np.arange(len(df_quadro)) == len(df_quadro) - 1)  # linha TOTAL
 
         # Checklist Obrigatório
         st.subheader("Checklist)")
-        df_check = build_checklist(root, ibs_pct=ibs_pct, cbs_pct=cbs_pct, tol=tolerance_centavos)
-        st.dataframe(df_check, use_container_width=True)
+        df_check = build_checklist(df_quadro, header, ibs_pct=ibs_pct, cbs_pct=cbs_pct, tol=tolerance_centavos)
+        falhas = (df_check["Status"] == "❌").to_numpy()
+        show_preview(
+            df_check, keep=falhas | (df_check["Grupo"] == "Totais").to_numpy(),
+            note=f", incluindo todas as {int(falhas.sum())} com ❌ e os Totais; só linhas ✅ foram omitidas",
+        )
 
         # vNF (valor total da NF)
-        vNF_text = gettext(root, ".//nfe:total/nfe:ICMSTot/nfe:vNF")
-        vNF_fmt = d(vNF_text).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        vNF_fmt = d(header["vNF"]).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
         st.info(f"**vNF (Valor total da NF):** R$ {vNF_fmt:,.2f}")
 
         # Download (Excel se possível; senão ZIP com CSVs)
@@ -385,7 +578,7 @@ if uploaded is not None:
             mime=mime
         )
 
-    except ET.ParseError:
+    except (ET.XMLSyntaxError, ET.ParseError):
         st.error("Arquivo inválido: não foi possível ler o XML. Verifique o conteúdo.")
     except Exception as e:
         st.exception(e)